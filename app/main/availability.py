@@ -0,0 +1,69 @@
+import hashlib
+import re
+
+from django.core.cache import cache
+
+from . import directory
+from webldap import settings
+
+
+def federez_uid(nick):
+    # netFederezUID derived from the nick when SSH access is enabled
+    return re.sub(r'[^a-zA-Z]+', '', nick)
+
+
+def check(uid=None, nick=None, exclude_dn=None, cached=True):
+    # Whether `uid` and `nick` are free, with a single equality search on uid, cn and
+    # netFederezUID. A nick is taken if it is someone's cn or if its derived netFederezUID
+    # is. Free answers are cached for AVAILABILITY_CACHE_TIMEOUT seconds; write paths pass
+    # cached=False.
+    key = 'availability:{}'.format(hashlib.sha1(
+        '{} {} {}'.format(uid, nick, exclude_dn).encode('utf-8')).hexdigest())
+    if cached:
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    terms = []
+    if uid:
+        terms.append('(uid={})'.format(directory.escape_filter(uid)))
+    if nick:
+        terms.append('(cn={})'.format(directory.escape_filter(nick)))
+        if federez_uid(nick):
+            terms.append('(netFederezUID={})'.format(federez_uid(nick)))  # Letters only
+
+    # Availability of each value asked for, and the attributes they collide with
+    result = {'conflicts': []}
+    if uid:
+        result['uid'] = True
+    if nick:
+        result['nick'] = True
+    if not terms:
+        return result
+
+    entries = directory.with_service(lambda l: list(l.search(
+        '(|{})'.format(''.join(terms)),
+        base='ou=users,{}'.format(settings.LDAP_BASE),
+        retrieve_attributes=['uid', 'cn', 'netFederezUID'])))
+
+    for entry in entries:
+        if exclude_dn and directory.normalize_dn(entry.dn) == directory.normalize_dn(exclude_dn):
+            continue
+        if uid and uid.lower() in {value.lower() for value in entry.uid}:
+            result['uid'] = False
+            result['conflicts'].append('uid')
+        if nick and nick.lower() in {value.lower() for value in entry.cn}:
+            result['nick'] = False
+            result['conflicts'].append('cn')
+        netfederez_uid = entry.get_attribute('netFederezUID')
+        # netFederezUID matches ignoring case, like uid and cn: "John" takes "john" (and its
+        # posix group) too
+        if nick and netfederez_uid is not None and federez_uid(nick).lower() in {
+                value.lower() for value in (netfederez_uid.values if netfederez_uid.multi_value
+                                            else [netfederez_uid.value])}:
+            result['nick'] = False
+            result['conflicts'].append('netFederezUID')
+
+    if not result['conflicts']:
+        cache.set(key, result, settings.AVAILABILITY_CACHE_TIMEOUT)
+    return result
@@ -0,0 +1,544 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import calendar
+import copy
+import ctypes.util
+import logging
+import os
+import threading
+import time
+
+from django.core.cache import cache
+from ldapom.cdef import ffi, libldap
+import cffi
+import ldapom
+
+from webldap import settings
+
+logger = logging.getLogger(__name__)
+
+# libldap reads these once, when the first connection of the process is initialized. They
+# bound the TCP connect and every synchronous operation, binds included.
+os.environ.setdefault('LDAPNETWORK_TIMEOUT', str(settings.LDAP_NETWORK_TIMEOUT))
+os.environ.setdefault('LDAPTIMEOUT', str(settings.LDAP_TIMEOUT))
+
+# libldap error strings meaning the server is down or stalled, rather than refusing the
+# operation
+OUTAGE_ERRORS = {
+    'Timed out',
+    'Time limit exceeded',
+    'Connect error',
+    'Server is busy',
+    'Server is unavailable',
+}
+
+
+class DirectoryUnavailable(Exception):
+    def __init__(self, retry_after):
+        super(DirectoryUnavailable, self).__init__('LDAP directory unavailable')
+        self.retry_after = retry_after
+
+
+def is_outage(e):
+    return isinstance(e, ldapom.error.LDAPServerDownError) or str(e) in OUTAGE_ERRORS
+
+
+# Circuit breaker, shared by the workers through the cache: after
+# LDAP_BREAKER_THRESHOLD consecutive failures, connections fail fast for
+# LDAP_BREAKER_COOLDOWN seconds. The first connection after the cooldown is let through
+# and trips the breaker again if it fails.
+def breaker_retry_after():
+    open_until = cache.get('directory:open_until', 0)
+    return max(0, int(open_until - time.time()))
+
+
+def record_failure():
+    cache.add('directory:failures', 0, None)
+    try:
+        failures = cache.incr('directory:failures')
+    except ValueError:
+        failures = 1
+
+    if failures >= settings.LDAP_BREAKER_THRESHOLD:
+        cache.set('directory:open_until', time.time() + settings.LDAP_BREAKER_COOLDOWN, None)
+
+
+def record_success():
+    if cache.get('directory:failures'):
+        cache.delete_many(['directory:failures', 'directory:open_until'])
+
+
+def connect(bind_dn, bind_password):
+    retry_after = breaker_retry_after()
+    if retry_after:
+        raise DirectoryUnavailable(retry_after)
+
+    try:
+        l = ldapom.LDAPConnection(uri=settings.LDAP_URI,
+                                  base=settings.LDAP_BASE,
+                                  bind_dn=bind_dn,
+                                  bind_password=bind_password,
+                                  timelimit=settings.LDAP_TIMELIMIT,
+                                  max_retry_reconnect=settings.LDAP_RECONNECT_RETRIES)
+    except ldapom.error.LDAPError as e:
+        if is_outage(e):
+            record_failure()
+            raise DirectoryUnavailable(settings.LDAP_BREAKER_COOLDOWN)
+        raise
+
+    record_success()
+    return l
+
+
+def connect_service():
+    return connect(settings.LDAP_WEBLDAP_USER, settings.LDAP_WEBLDAP_PASSWD)
+
+
+def get_entry(l, dn, **kwargs):
+    # Fetch an entry in a single operation, None if it does not exist
+    entry = l.get_entry(dn, **kwargs)
+    try:
+        entry.fetch()
+    except ldapom.error.LDAPNoSuchObjectError:
+        return None
+    return entry
+
+
+def stamps(l, dn, attributes=('entryCSN', 'modifyTimestamp')):
+    # Change stamps of an entry from a single base-scope read of operational attributes, None
+    # if the entry does not exist or has none of them
+    try:
+        entry = next(l.search(base=dn, scope=ldapom.LDAP_SCOPE_BASE,
+                              retrieve_attributes=list(attributes)))
+    except StopIteration:
+        return None
+
+    stamp = []
+    for name in attributes:
+        attribute = entry.get_attribute(name)
+        if attribute is not None:
+            values = attribute.values if attribute.multi_value else {attribute.value}
+            stamp.append('{}={}'.format(name, ','.join(sorted(values))))
+    return ' '.join(stamp) or None
+
+
+def escape_filter(value):
+    # Escape a value for use in a search filter (RFC 4515)
+    for c in '\\*()\0':
+        value = value.replace(c, '\\{:02x}'.format(ord(c)))
+    return value
+
+
+def normalize_dn(dn):
+    return ','.join(rdn.strip() for rdn in dn.split(',')).lower()
+
+
+# Functions of libldap which ldapom does not declare, through a separate FFI. Handles are
+# passed as addresses.
+_native_ffi = None
+_native_ldap = None
+_native_lber = None
+
+_NATIVE_CDEF = """
+typedef struct berval { unsigned long bv_len; char *bv_val; } BerValue;
+
+int ldap_unbind_ext_s(void *ld, void *sctrls, void *cctrls);
+int ldap_create_page_control(void *ld, int pagesize, struct berval *cookie, char iscritical,
+                             void **ctrlp);
+int ldap_parse_pageresponse_control(void *ld, void *ctrl, int *count, struct berval *cookie);
+void *ldap_control_find(const char *oid, void **ctrls, void ***nextctrlp);
+void ldap_control_free(void *ctrl);
+void ldap_controls_free(void **ctrls);
+int ldap_search_ext_s(void *ld, char *base, int scope, char *filter, char *attrs[],
+                      int attrsonly, void **serverctrls, void **clientctrls, void *timeout,
+                      int sizelimit, void **res);
+int ldap_parse_result(void *ld, void *res, int *errcodep, char **matcheddnp, char **errmsgp,
+                      char ***referralsp, void ***serverctrls, int freeit);
+void *ldap_first_entry(void *ld, void *res);
+void *ldap_next_entry(void *ld, void *entry);
+char *ldap_get_dn(void *ld, void *entry);
+char *ldap_first_attribute(void *ld, void *entry, void **berptr);
+char *ldap_next_attribute(void *ld, void *entry, void *ber);
+struct berval **ldap_get_values_len(void *ld, void *entry, char *attr);
+int ldap_count_values_len(struct berval **vals);
+void ldap_value_free_len(struct berval **vals);
+void ldap_memfree(void *p);
+int ldap_msgfree(void *msg);
+void ber_free(void *ber, int freebuf);
+void ber_memfree(void *p);
+"""
+
+
+def _native(l):
+    # FFI, libldap, liblber and the handle of `l` for them
+    global _native_ffi, _native_ldap, _native_lber
+
+    if _native_ffi is None:
+        native = cffi.FFI()
+        native.cdef(_NATIVE_CDEF)
+        _native_lber = native.dlopen(ctypes.util.find_library('lber') or 'lber')
+        _native_ldap = native.dlopen(ctypes.util.find_library('ldap') or 'ldap')
+        _native_ffi = native
+
+    ld = _native_ffi.cast('void *', int(ffi.cast('uintptr_t', l._ld)))
+    return _native_ffi, _native_ldap, _native_lber, ld
+
+
+# Simple paged results control (RFC 2696)
+PAGED_RESULTS_OID = b'1.2.840.113556.1.4.319'
+
+
+def paged_search(l, base, search_filter='(objectClass=*)', retrieve_attributes=None):
+    # Subtree search returning the entries LDAP_PAGE_SIZE at a time, so that large subtrees
+    # stay within the server size limit per response. ldapom has no support for controls,
+    # the pages are read with libldap directly. For the total to be unlimited as well, the
+    # bind DN needs e.g. `olcLimits: dn.exact="..." size.prtotal=unlimited` in slapd.
+    native, lib, lber, ld = _native(l)
+
+    names = [native.new('char[]', name.encode('utf-8'))
+             for name in retrieve_attributes or ['*']]
+    attrs = native.new('char *[]', names + [native.NULL])
+    cookie = native.new('struct berval *')
+
+    try:
+        while True:
+            control = native.new('void **')
+            ldapom.connection.handle_ldap_error(lib.ldap_create_page_control(
+                ld, settings.LDAP_PAGE_SIZE, cookie, b'\0', control))
+            server_controls = native.new('void *[]', [control[0], native.NULL])
+
+            res = native.new('void **')
+            err = lib.ldap_search_ext_s(ld, base.encode('utf-8'), libldap.LDAP_SCOPE_SUBTREE,
+                                        search_filter.encode('utf-8'), attrs, 0,
+                                        server_controls, native.NULL, native.NULL, 0, res)
+            lib.ldap_control_free(control[0])
+            response_controls = native.new('void ***')
+            try:
+                if err == libldap.LDAP_NO_SUCH_OBJECT:
+                    return
+                ldapom.connection.handle_ldap_error(err)
+
+                code = native.new('int *')
+                ldapom.connection.handle_ldap_error(lib.ldap_parse_result(
+                    ld, res[0], code, native.NULL, native.NULL, native.NULL,
+                    response_controls, 0))
+                # e.g. the size limit of the bind DN for paged searches (size.prtotal)
+                ldapom.connection.handle_ldap_error(code[0])
+
+                page = _page_entries(l, native, lib, lber, ld, res[0], retrieve_attributes)
+
+                # Cookie of the next page; none if the server ignored the control
+                if cookie.bv_val != native.NULL:
+                    lber.ber_memfree(cookie.bv_val)
+                    cookie.bv_val = native.NULL
+                    cookie.bv_len = 0
+                if response_controls[0] != native.NULL:
+                    found = lib.ldap_control_find(PAGED_RESULTS_OID, response_controls[0],
+                                                  native.NULL)
+                    if found != native.NULL:
+                        ldapom.connection.handle_ldap_error(
+                            lib.ldap_parse_pageresponse_control(
+                                ld, found, native.new('int *'), cookie))
+            finally:
+                if response_controls[0] != native.NULL:
+                    lib.ldap_controls_free(response_controls[0])
+                if res[0] != native.NULL:
+                    lib.ldap_msgfree(res[0])
+
+            for entry in page:
+                yield entry
+            if not cookie.bv_len:
+                return
+    finally:
+        if cookie.bv_val != native.NULL:
+            lber.ber_memfree(cookie.bv_val)
+
+
+def _page_entries(l, native, lib, lber, ld, res, retrieve_attributes):
+    # ldapom entries of a search result, built as LDAPConnection.search() does
+    entries = []
+    message = lib.ldap_first_entry(ld, res)
+    while message != native.NULL:
+        dn_p = lib.ldap_get_dn(ld, message)
+        dn = native.string(dn_p).decode('utf-8')
+        lib.ldap_memfree(dn_p)
+
+        entry = ldapom.LDAPEntry(l, dn, retrieve_attributes=retrieve_attributes)
+        entry._attributes = set()
+        ber = native.new('void **')
+        name_p = lib.ldap_first_attribute(ld, message, ber)
+        while name_p != native.NULL:
+            name = native.string(name_p).decode('utf-8')
+            values_p = lib.ldap_get_values_len(ld, message, name_p)
+            values = [native.buffer(values_p[i].bv_val, values_p[i].bv_len)[:]
+                      for i in range(lib.ldap_count_values_len(values_p))]
+            lib.ldap_value_free_len(values_p)
+            lib.ldap_memfree(name_p)
+
+            attribute = l.get_attribute_type(name)(name)
+            attribute._set_ldap_values(values)
+            entry._attributes.add(attribute)
+            name_p = lib.ldap_next_attribute(ld, message, ber[0])
+        if ber[0] != native.NULL:
+            lber.ber_free(ber[0], 0)
+
+        entry._fetched_attributes = copy.deepcopy(entry._attributes)
+        entries.append(entry)
+        message = lib.ldap_next_entry(ld, message)
+    return entries
+
+
+def modify(l, dn, changes):
+    # Apply `changes`, a list of (operation, attribute, values) where operation is 'add' or
+    # 'delete', in a single modify operation. LDAPEntry.save() replaces whole attributes,
+    # this only sends the given values, which matters for groups with many members.
+    operations = {'add': libldap.LDAP_MOD_ADD, 'delete': libldap.LDAP_MOD_DELETE}
+
+    # Keep references to the memory pointed to by the request
+    prevent_garbage_collection = []
+
+    mods = ffi.new('LDAPMod*[{}]'.format(len(changes) + 1))
+    for i, (operation, name, values) in enumerate(changes):
+        mod = ffi.new('LDAPMod *')
+        mod.mod_op = operations[operation] | libldap.LDAP_MOD_BVALUES
+        mod_type = ffi.new('char[]', name.encode('utf-8'))
+        mod.mod_type = mod_type
+
+        bvals = ffi.new('BerValue*[{}]'.format(len(values) + 1))
+        for j, value in enumerate(values):
+            value = value.encode('utf-8')
+            berval = ffi.new('BerValue *')
+            bval = ffi.new('char[]', value)
+            berval.bv_len = len(value)
+            berval.bv_val = bval
+            bvals[j] = berval
+            prevent_garbage_collection.extend([berval, bval])
+        bvals[len(values)] = ffi.NULL
+        mod.mod_vals = {'modv_bvals': bvals}
+
+        mods[i] = mod
+        prevent_garbage_collection.extend([mod, mod_type, bvals])
+    mods[len(changes)] = ffi.NULL
+
+    err = libldap.ldap_modify_ext_s(l._ld, dn.encode('utf-8'), mods, ffi.NULL, ffi.NULL)
+    ldapom.connection.handle_ldap_error(err)
+
+
+# Executor bridge: independent read operations of a request run concurrently on a bounded
+# pool of threads, so a page waits for its slowest operation rather than for their sum. The
+# number of in-flight operations per process is bounded by LDAP_CONCURRENCY instead of the
+# number of workers. The first operation runs on the request connection, the others on idle
+# connections bound as the same user, kept for the next requests of that user.
+_executor = None
+_executor_lock = threading.Lock()
+
+# Idle connections by (bind DN, password), least recently used first. At most LDAP_POOL_SIZE
+# are kept per process, the oldest are unbound beyond that.
+_pool = OrderedDict()
+_pool_lock = threading.Lock()
+
+
+def _acquire(key):
+    _check_fork()
+    with _pool_lock:
+        idle = _pool.get(key)
+        if idle:
+            connection = idle.pop()
+            if not idle:
+                del _pool[key]
+            return connection
+    return connect(*key)
+
+
+def _release(key, connection):
+    evicted = []
+    _check_fork()
+    with _pool_lock:
+        _pool.setdefault(key, []).append(connection)
+        _pool.move_to_end(key)
+        size = sum(len(idle) for idle in _pool.values())
+        while size > settings.LDAP_POOL_SIZE:
+            oldest, idle = next(iter(_pool.items()))
+            evicted.append(idle.pop(0))
+            if not idle:
+                del _pool[oldest]
+            size -= 1
+
+    for connection in evicted:
+        close(connection)
+
+
+def close(l):
+    # ldapom has no unbind: its connections stay open until the process exits
+    native, lib, lber, ld = _native(l)
+    l._ld = ffi.NULL
+    lib.ldap_unbind_ext_s(ld, native.NULL, native.NULL)
+
+
+def executor():
+    global _executor
+
+    _check_fork()
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.LDAP_CONCURRENCY)
+    return _executor
+
+
+def gather(l, *calls):
+    # Call each `call(connection)` with a connection bound as `l` and return their results
+    # in order. Results must not be lazy: generators and entries are consumed or fetched by
+    # the calls themselves.
+    if not settings.LDAP_CONCURRENCY or len(calls) < 2:
+        return [call(l) for call in calls]
+
+    key = (l._bind_dn, l._bind_password)
+
+    def run(call):
+        connection = _acquire(key)
+        try:
+            result = call(connection)
+        except Exception:
+            # The connection may be broken, do not hand it out again
+            close(connection)
+            raise
+        _release(key, connection)
+        return result
+
+    futures = [executor().submit(run, call) for call in calls[1:]]
+    first = calls[0](l)
+    return [first] + [future.result() for future in futures]
+
+
+# Per-process cache of entries read on most pages and rarely changed (roles, access groups).
+# Entries are read with the service account, so that what is cached does not depend on the
+# ACLs of the user who happened to fill it, and kept as {attribute: set of values} for at
+# most LDAP_ENTRY_CACHE_TIMEOUT seconds, in case an invalidation is missed (no poller, or a
+# cache not shared by the workers). Entries the service account cannot read are read with
+# the request connection `l`, when given.
+_entries = {}
+_service = None
+_service_lock = threading.Lock()
+
+
+# Process which opened the connections and threads of this module. Preloading servers
+# (gunicorn --preload) load the application, and run the warm-up, in the master: forked
+# workers must not share its sockets nor expect its threads, they start afresh.
+_pid = os.getpid()
+
+
+def _check_fork():
+    global _pid, _executor, _executor_lock, _pool, _pool_lock, _service, _service_lock
+
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        _executor = None
+        _executor_lock = threading.Lock()
+        _pool = OrderedDict()
+        _pool_lock = threading.Lock()
+        _service = None
+        _service_lock = threading.Lock()
+
+
+def with_service(call):
+    # Call `call(connection)` with the service connection shared by the process
+    global _service
+
+    _check_fork()
+    with _service_lock:
+        if _service is None:
+            _service = connect_service()
+        return call(_service)
+
+
+def cached_entry(dn, l=None):
+    expires, entry = _entries.get(dn.lower(), (0, None))
+    if expires > time.time():
+        return entry
+
+    fetched = with_service(partial(get_entry, dn=dn, retrieve_operational_attributes=True))
+    if fetched is None and l is not None:
+        fetched = get_entry(l, dn, retrieve_operational_attributes=True)
+
+    if fetched is None:
+        return None
+
+    entry = {}
+    for attribute in fetched._attributes:
+        entry[attribute.name] = set(attribute.values if attribute.multi_value
+                                    else [attribute.value])
+    _entries[dn.lower()] = (time.time() + settings.LDAP_ENTRY_CACHE_TIMEOUT, entry)
+    return entry
+
+
+def invalidate(dn):
+    # Local eviction after a write of this process; other workers are told by the poller
+    _entries.pop(dn.lower(), None)
+
+
+# Cross-worker invalidation. The `watchdirectory` command polls the directory and appends
+# the changed DNs to a log in the cache, numbered by a sequence; each worker applies the new
+# part of the log before handling a request. The cache must be shared by the poller and the
+# workers (memcached, or the file cache on a single host).
+def _parse_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y%m%d%H%M%SZ'))
+
+
+def publish_invalidations(changes):
+    # `changes` is a list of (dn, modifyTimestamp); the DN '*' evicts every entry
+    log = cache.get('directory:invalidations') or []
+    seq = log[-1][0] if log else 0
+    for dn, timestamp in changes:
+        seq += 1
+        log.append((seq, dn.lower(), _parse_timestamp(timestamp) if timestamp else None))
+
+    cache.set('directory:invalidations', log[-settings.LDAP_INVALIDATION_LOG:], None)
+    cache.set('directory:invalidation_seq', seq, None)
+    return seq
+
+
+_seen_seq = None
+
+
+def apply_invalidations():
+    global _seen_seq
+
+    seq = cache.get('directory:invalidation_seq', 0)
+    if _seen_seq is None or seq < _seen_seq:  # First request, or the cache was flushed
+        _seen_seq = seq
+        _entries.clear()
+        return
+    if seq == _seen_seq:
+        return
+
+    log = cache.get('directory:invalidations') or []
+    if not log or log[0][0] > _seen_seq + 1:
+        # Part of the log was trimmed before we could read it
+        _entries.clear()
+    else:
+        lags = []
+        for entry_seq, dn, changed_at in log:
+            if entry_seq > _seen_seq:
+                if dn == '*':
+                    _entries.clear()
+                _entries.pop(dn, None)
+                if changed_at is not None:
+                    lags.append(time.time() - changed_at)
+        if lags:
+            _record_lag(max(lags))
+
+    _seen_seq = seq
+
+
+def _record_lag(lag):
+    # Delay between a change in the directory and its eviction here, per worker process
+    logger.info('Applied directory invalidations with a lag of %.1f s', lag)
+    lags = cache.get('directory:invalidation_lag') or {}
+    worst = lags.get(os.getpid(), (0, 0))[1]
+    lags[os.getpid()] = (lag, max(lag, worst))
+    cache.set('directory:invalidation_lag', lags, None)
+
+
+def invalidation_lag():
+    return cache.get('directory:invalidation_lag') or {}
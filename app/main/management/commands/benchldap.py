@@ -0,0 +1,81 @@
+import getpass
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+
+from main import directory
+from webldap import settings
+
+
+class Command(BaseCommand):
+    help = ('Compare page latency and binds with LDAP reads run one after the other and run '
+            'concurrently (LDAP_CONCURRENCY), for requests alternating between several users.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('uid', nargs='+',
+                            help='Users to log in as, requests go to each in turn.')
+        parser.add_argument('--org', action='append', default=[],
+                            help='Association page to request, can be repeated.')
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Number of requests per page and mode (default: 50).')
+        parser.add_argument('--concurrency', type=int,
+                            default=settings.LDAP_CONCURRENCY or 8,
+                            help='Threads for the concurrent mode (default: LDAP_CONCURRENCY '
+                                 'or 8).')
+
+    def handle(self, *args, **options):
+        passwds = [getpass.getpass('Password for {}: '.format(uid)) for uid in options['uid']]
+        paths = ['/', '/admin/'] + ['/org/{}/'.format(org) for org in options['org']]
+
+        # Count the connections opened, by the views and the executor alike
+        self.binds = 0
+        connect = directory.connect
+
+        def counting_connect(*args, **kwargs):
+            self.binds += 1
+            return connect(*args, **kwargs)
+
+        # No page fragments nor fallback contexts: every request goes to LDAP
+        dummy = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        saved = settings.LDAP_CONCURRENCY
+        directory.connect = counting_connect
+        try:
+            with override_settings(CACHES=dummy, ALLOWED_HOSTS=['testserver']):
+                clients = [self.login(uid, passwd)
+                           for uid, passwd in zip(options['uid'], passwds)]
+                for concurrency in (0, options['concurrency']):
+                    settings.LDAP_CONCURRENCY = concurrency
+                    for path in paths:
+                        self.bench(clients, path, concurrency, options['requests'])
+                for client in clients:
+                    client.session.delete()
+        finally:
+            settings.LDAP_CONCURRENCY = saved
+            directory.connect = connect
+
+    def login(self, uid, passwd):
+        client = Client()
+        session = client.session
+        session['ldap_connected'] = True
+        session['ldap_binduid'] = uid
+        session['ldap_binddn'] = 'uid={},ou=users,{}'.format(uid, settings.LDAP_BASE)
+        session['ldap_passwd'] = passwd
+        session.save()
+        return client
+
+    def bench(self, clients, path, concurrency, requests):
+        # First request of each user fills the connection pool
+        for client in clients:
+            client.get(path)
+
+        self.binds = 0
+        start = time.perf_counter()
+        for i in range(requests):
+            response = clients[i % len(clients)].get(path)
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write('{:<25} concurrency={:<3} {:>8.1f} ms/req {:>5.1f} binds/req '
+                          '(status {})'.format(path, concurrency, 1000 * elapsed / requests,
+                                               self.binds / requests, response.status_code))
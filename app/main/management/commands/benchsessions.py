@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+
+ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+    'django.contrib.sessions.backends.cache',
+)
+
+
+class Command(BaseCommand):
+    help = 'Compare the requests per second served with each session engine.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000,
+                            help='Number of requests per engine (default: 1000).')
+        parser.add_argument('--path', default='/help/',
+                            help='Page to request; it must not need LDAP (default: /help/).')
+
+    def handle(self, *args, **options):
+        for engine in ENGINES:
+            with override_settings(SESSION_ENGINE=engine, ALLOWED_HOSTS=['testserver']):
+                rate = self.bench(options['path'], options['requests'])
+            self.stdout.write('{:<45} {:>8.1f} req/s'.format(engine, rate))
+
+    def bench(self, path, requests):
+        # Logged-in session as stored by the login view, read on every page by session_info
+        client = Client()
+        session = client.session
+        session['ldap_connected'] = True
+        session['ldap_binduid'] = 'bench'
+        session['ldap_binddn'] = 'uid=bench'
+        session['is_admin'] = False
+        session.save()
+
+        # Warm the cache and the template loaders before timing
+        client.get(path)
+
+        start = time.perf_counter()
+        for i in range(requests):
+            client.get(path)
+        elapsed = time.perf_counter() - start
+
+        session.delete()
+        return requests / elapsed
@@ -0,0 +1,136 @@
+from collections import defaultdict
+import time
+
+from django.core.management.base import BaseCommand
+import ldapom
+
+from main import directory
+from webldap import settings
+
+# Attributes referencing user DNs, per subtree
+REFERENCES = (
+    ('ou=associations', ('uniqueMember', 'owner')),
+    ('ou=groups', ('uniqueMember',)),
+    ('ou=roles', ('roleOccupant',)),
+)
+
+
+class Command(BaseCommand):
+    help = ('Check the directory for dangling member references to users, users without uid, '
+            'duplicate uidNumber/gidNumber and memberUid values without a matching '
+            'netFederezUID.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Remove dangling references to users and unknown memberUid '
+                                 'values, with one modify operation per entry.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        l = directory.connect_service()
+        self.problems = 0
+        self.other_dns = {}
+        self.unverified = defaultdict(set)
+        self.users_base = directory.normalize_dn('ou=users,{}'.format(settings.LDAP_BASE))
+
+        users = self.scan_users(l)
+
+        # Values to remove, by entry DN and attribute. Sets: an entry returned twice must not
+        # have its values deleted twice, the modify would fail.
+        repairs = defaultdict(lambda: defaultdict(set))
+
+        for ou, attributes in REFERENCES:
+            base = '{},{}'.format(ou, settings.LDAP_BASE)
+            for entry in directory.paged_search(l, base,
+                                                retrieve_attributes=list(attributes)):
+                for attribute in attributes:
+                    for dn in getattr(entry, attribute):
+                        found = self.exists(l, users, dn)
+                        if found is None:
+                            self.unverified[dn].add(entry.dn)
+                        elif not found:
+                            self.report('{}: dangling {} {}'.format(entry.dn, attribute, dn))
+                            repairs[entry.dn][attribute].add(dn)
+
+        gid_numbers = defaultdict(set)
+        base = 'ou=groups,{}'.format(settings.LDAP_BASE)
+        for group in directory.paged_search(l, base, '(objectClass=posixGroup)',
+                                            ['gidNumber', 'memberUid']):
+            gid_number = group.get_attribute('gidNumber')
+            if gid_number is not None:
+                gid_numbers[gid_number.value].add(directory.normalize_dn(group.dn))
+            for member_uid in group.memberUid:
+                if member_uid not in users['netFederezUID']:
+                    self.report('{}: memberUid {} matches no netFederezUID'
+                                .format(group.dn, member_uid))
+                    repairs[group.dn]['memberUid'].add(member_uid)
+
+        for kind, numbers in (('uidNumber', users['uidNumber']), ('gidNumber', gid_numbers)):
+            for number, dns in sorted(numbers.items()):
+                if len(dns) > 1:
+                    self.report('{} {} is used by {}'.format(kind, number, ', '.join(sorted(dns))))
+
+        # Left as they are, even with --repair
+        if self.unverified:
+            self.stdout.write('{} references outside of ou=users could not be verified:'
+                              .format(len(self.unverified)))
+            for dn, entries in sorted(self.unverified.items()):
+                self.stdout.write('  {} (in {})'.format(dn, ', '.join(sorted(entries))))
+
+        if options['repair']:
+            repaired = 0
+            for dn, attributes in sorted(repairs.items()):
+                try:
+                    directory.modify(l, dn, [('delete', attribute, sorted(values))
+                                             for attribute, values in attributes.items()])
+                except ldapom.error.LDAPError as e:
+                    # e.g. removing the last uniqueMember of a groupOfUniqueNames
+                    self.stderr.write('{}: not repaired: {}'.format(dn, e))
+                else:
+                    repaired += 1
+            self.stdout.write('Repaired {} of {} entries'.format(repaired, len(repairs)))
+
+        self.stdout.write('{} users checked, {} problems found in {:.1f} s'.format(
+            len(users['dns']), self.problems, time.perf_counter() - start))
+
+    def scan_users(self, l):
+        # Single pass over the users, keeping only what the checks need
+        users = {'dns': set(), 'netFederezUID': set(), 'uidNumber': defaultdict(set)}
+
+        base = 'ou=users,{}'.format(settings.LDAP_BASE)
+        for user in directory.paged_search(l, base, '(objectClass=inetOrgPerson)',
+                                           ['uid', 'uidNumber', 'netFederezUID']):
+            users['dns'].add(directory.normalize_dn(user.dn))
+            if not user.uid:
+                self.report('{}: no uid'.format(user.dn))
+
+            uid_number = user.get_attribute('uidNumber')
+            if uid_number is not None:
+                users['uidNumber'][uid_number.value].add(directory.normalize_dn(user.dn))
+            netfederez_uid = user.get_attribute('netFederezUID')
+            if netfederez_uid is not None:
+                users['netFederezUID'].update(netfederez_uid.values
+                                              if netfederez_uid.multi_value
+                                              else [netfederez_uid.value])
+        return users
+
+    def exists(self, l, users, dn):
+        # True or False, or None when it cannot be known
+        normalized = directory.normalize_dn(dn)
+        if normalized.endswith(',' + self.users_base):
+            return normalized in users['dns']
+
+        # References outside of the users (service accounts...) are looked up one by one. The
+        # service account may not be allowed to read them: not finding one proves nothing.
+        if normalized not in self.other_dns:
+            try:
+                self.other_dns[normalized] = bool(list(
+                    l.search(base=dn, scope=ldapom.LDAP_SCOPE_BASE,
+                             retrieve_attributes=['1.1']))) or None
+            except ldapom.error.LDAPError:  # Invalid DN, no access
+                self.other_dns[normalized] = None
+        return self.other_dns[normalized]
+
+    def report(self, message):
+        self.problems += 1
+        self.stdout.write(message)
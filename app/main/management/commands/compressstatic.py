@@ -0,0 +1,70 @@
+import gzip
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webldap import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Types worth compressing; images are already compressed
+EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.map', '.ico')
+MIN_SIZE = 256
+
+
+def compress_gzip(data):
+    # Fixed mtime, so that an unchanged file gives the same copy
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class Command(BaseCommand):
+    help = ('Write gzip (and brotli, if the module is installed) copies of the text files '
+            'of STATIC_ROOT, next to them, for the static files WSGI middleware. Run it '
+            'after collectstatic.')
+
+    def handle(self, *args, **options):
+        if not settings.STATIC_ROOT:
+            raise CommandError('STATIC_ROOT is not set')
+
+        compressors = [('.gz', compress_gzip)]
+        if brotli is not None:
+            compressors.append(('.br', lambda data: brotli.compress(data, quality=11)))
+        else:
+            self.stderr.write('brotli is not installed, only writing gzip copies')
+
+        files = written = original_size = compressed_size = 0
+        for directory, dirs, names in os.walk(settings.STATIC_ROOT):
+            for name in names:
+                if not name.endswith(EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if len(data) < MIN_SIZE:
+                    continue
+
+                files += 1
+                for suffix, compress in compressors:
+                    compressed = compress(data)
+                    # Not worth a Content-Encoding
+                    if len(compressed) >= len(data) * 0.95:
+                        if os.path.exists(path + suffix):
+                            os.remove(path + suffix)
+                        continue
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                    # Readable by the web server, whatever the umask of the settings
+                    os.chmod(path + suffix, 0o644)
+                    written += 1
+                    original_size += len(data)
+                    compressed_size += len(compressed)
+
+        self.stdout.write('{} files, {} compressed copies written ({} kB -> {} kB)'.format(
+            files, written, original_size // 1024, compressed_size // 1024))
@@ -0,0 +1,84 @@
+from collections import Counter, defaultdict
+import glob
+import os
+
+from django.core.management.base import BaseCommand
+
+from webldap import settings
+
+# Where the time of a sample goes, by the first matching module prefix of its stack. Template
+# rendering calling LDAP (lazy context values) counts as LDAP.
+CATEGORIES = (
+    ('ldap', ('ldapom', 'main.directory')),
+    ('templates', ('django.template',)),
+)
+
+
+def category(frames):
+    for name, prefixes in CATEGORIES:
+        if any(frame.startswith(prefixes) for frame in frames):
+            return name
+    return 'python'
+
+
+class Command(BaseCommand):
+    help = ('Merge the folded stacks written by the profiling middleware and summarise them '
+            'per view.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Folded stack files or directories (default: PROFILING_DIR).')
+        parser.add_argument('--view', help='Only keep the samples of this view.')
+        parser.add_argument('--output',
+                            help='Write the merged stacks to this file, for flamegraph.pl.')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of functions listed per view (default: 10).')
+
+    def handle(self, *args, **options):
+        stacks = Counter()
+        for path in self.files(options['paths'] or [settings.PROFILING_DIR]):
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    view = stack.split(';', 1)[0]
+                    if stack and options['view'] in (None, view):
+                        stacks[stack] += int(count)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.writelines('{} {}\n'.format(stack, count)
+                             for stack, count in sorted(stacks.items()))
+
+        views = defaultdict(lambda: {'samples': 0, 'categories': Counter(),
+                                     'self': Counter(), 'total': Counter()})
+        for stack, count in stacks.items():
+            view, *frames = stack.split(';')
+            summary = views[view]
+            summary['samples'] += count
+            summary['categories'][category(frames)] += count
+            if frames:
+                summary['self'][frames[-1]] += count
+            for frame in set(frames):
+                summary['total'][frame] += count
+
+        total = sum(summary['samples'] for summary in views.values())
+        self.stdout.write('{} samples of {:.0f} ms'.format(
+            total, 1000 * settings.PROFILING_INTERVAL))
+        for view, summary in sorted(views.items(), key=lambda item: -item[1]['samples']):
+            samples = summary['samples']
+            self.stdout.write('\n{} ({} samples, {:.0%})'.format(view, samples, samples / total))
+            self.stdout.write('  ' + ', '.join(
+                '{} {:.0%}'.format(name, summary['categories'][name] / samples)
+                for name in ('ldap', 'templates', 'python')))
+            for kind in ('self', 'total'):
+                self.stdout.write('  {}:'.format(kind))
+                for frame, count in summary[kind].most_common(options['top']):
+                    self.stdout.write('    {:>6.1%}  {}'.format(count / samples, frame))
+
+    def files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(glob.glob(os.path.join(path, '*.folded'))):
+                    yield name
+            else:
+                yield path
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main import ratelimit
+
+
+class Command(BaseCommand):
+    help = 'Show the login and password reset rate limiter counters.'
+
+    def handle(self, *args, **options):
+        for name, value in sorted(ratelimit.stats().items()):
+            self.stdout.write('{:<15} {}'.format(name, value))
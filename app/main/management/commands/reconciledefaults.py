@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand
+import ldapom
+
+from main import directory
+from webldap import settings
+
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class Command(BaseCommand):
+    help = ('Add every user missing from LDAP_DEFAULT_GROUPS and LDAP_DEFAULT_ROLES, with '
+            'multi-value add operations.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the missing members.')
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='Members added per modify operation (default: 1000).')
+
+    def handle(self, *args, **options):
+        l = directory.connect_service()
+
+        start = time.perf_counter()
+        users = {}
+        for user in directory.paged_search(l, 'ou=users,{}'.format(settings.LDAP_BASE),
+                                           '(objectClass=inetOrgPerson)', ['1.1']):
+            users[directory.normalize_dn(user.dn)] = user.dn
+        elapsed = time.perf_counter() - start
+        self.stdout.write('{} users read in {:.1f} s ({:.0f}/s)'.format(
+            len(users), elapsed, len(users) / elapsed if elapsed else 0))
+
+        targets = [('cn={},ou=accesses,ou=groups,{}'.format(group, settings.LDAP_BASE),
+                    'uniqueMember') for group in settings.LDAP_DEFAULT_GROUPS]
+        targets.extend(('cn={},ou=roles,{}'.format(role, settings.LDAP_BASE), 'roleOccupant')
+                       for role in settings.LDAP_DEFAULT_ROLES)
+
+        changed = []
+        for dn, attribute in targets:
+            try:
+                entry = next(l.search(base=dn, scope=ldapom.LDAP_SCOPE_BASE,
+                                      retrieve_attributes=[attribute]))
+            except (StopIteration, ldapom.error.LDAPNoSuchObjectError):
+                self.stderr.write('{}: does not exist'.format(dn))
+                continue
+
+            members = {directory.normalize_dn(member) for member in getattr(entry, attribute)}
+            missing = sorted(users[user] for user in users.keys() - members)
+            self.stdout.write('{}: {} members, {} missing'.format(dn, len(members), len(missing)))
+            if options['dry_run'] or not missing:
+                continue
+
+            start = time.perf_counter()
+            added = 0
+            for chunk in chunks(missing, options['batch']):
+                try:
+                    directory.modify(l, dn, [('add', attribute, chunk)])
+                except ldapom.error.LDAPError as e:
+                    # e.g. a member added since the read: the whole chunk is refused
+                    self.stderr.write('{}: {} members not added: {}'.format(dn, len(chunk), e))
+                else:
+                    added += len(chunk)
+            elapsed = time.perf_counter() - start
+            self.stdout.write('{}: {} added in {:.1f} s ({:.0f}/s)'.format(
+                dn, added, elapsed, added / elapsed if elapsed else 0))
+            if added:
+                changed.append((dn, None))
+
+        # Cached copies of these entries in the workers are now stale
+        if changed:
+            directory.publish_invalidations(changed)
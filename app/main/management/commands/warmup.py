@@ -0,0 +1,85 @@
+import getpass
+import json
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+
+from main import warmup
+from webldap import settings
+
+
+class Command(BaseCommand):
+    help = ('Compare the latency of the first requests of a fresh worker with and without '
+            'the warm-up stage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uid', help='Log in as this user to also request the profile '
+                                          'page, which needs LDAP.')
+        parser.add_argument('--path', action='append', default=[],
+                            help='Page to request, can be repeated (default: /login/).')
+        parser.add_argument('--child', choices=('cold', 'warm'),
+                            help='Internal: run one measure in this process.')
+
+    def handle(self, *args, **options):
+        paths = list(options['path'] or ['/login/'])
+        if options['uid']:
+            paths.append('/')
+
+        if options['child']:
+            passwd = sys.stdin.readline().rstrip('\n') if options['uid'] else None
+            report = self.measure(options['child'] == 'warm', options['uid'], passwd, paths)
+            self.stdout.write(json.dumps(report))
+            return
+
+        passwd = getpass.getpass('Password for {}: '.format(options['uid'])) \
+            if options['uid'] else ''
+
+        self.stdout.write('{:<6} {:<12} {:<20} {:>10} {:>10}'.format(
+            'mode', 'warm-up', 'page', 'first', 'second'))
+        for mode in ('cold', 'warm'):
+            # Each measure needs a fresh process
+            command = [sys.executable, sys.argv[0], 'warmup', '--child', mode]
+            if options['uid']:
+                command.extend(['--uid', options['uid']])
+            for path in options['path']:
+                command.extend(['--path', path])
+            output = subprocess.check_output(command, input=(passwd + '\n').encode('utf-8'))
+            report = json.loads(output.decode('utf-8').splitlines()[-1])
+
+            for path, first, second in report['pages']:
+                self.stdout.write('{:<6} {:>9.0f} ms {:<20} {:>7.0f} ms {:>7.0f} ms'.format(
+                    mode, 1000 * report['warmup'], path, 1000 * first, 1000 * second))
+
+    def measure(self, warm, uid, passwd, paths):
+        start = time.perf_counter()
+        if warm:
+            warmup.run()
+        elapsed = time.perf_counter() - start
+
+        pages = []
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            client = Client()
+            if uid:
+                session = client.session
+                session['ldap_connected'] = True
+                session['ldap_binduid'] = uid
+                session['ldap_binddn'] = 'uid={},ou=users,{}'.format(uid, settings.LDAP_BASE)
+                session['ldap_passwd'] = passwd
+                session.save()
+
+            for path in paths:
+                timings = []
+                for i in range(2):
+                    start = time.perf_counter()
+                    client.get(path)
+                    timings.append(time.perf_counter() - start)
+                pages.append([path] + timings)
+
+            if uid:
+                client.session.delete()
+
+        return {'warmup': elapsed, 'pages': pages}
@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand
+import ldapom
+
+from main import directory
+from webldap import settings
+
+
+class Command(BaseCommand):
+    help = ('Poll the directory for changes and publish the changed DNs so that every '
+            'worker evicts them from its cache.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', action='store_true',
+                            help='Show the invalidation lag measured by the workers and exit.')
+
+    def handle(self, *args, **options):
+        if options['lag']:
+            for pid, (last, worst) in sorted(directory.invalidation_lag().items()):
+                self.stdout.write('worker {:<8} last {:6.1f} s   max {:6.1f} s'
+                                  .format(pid, last, worst))
+            return
+
+        l = None
+        mark = None
+        while True:
+            try:
+                if l is None:
+                    l = directory.connect_service()
+                mark = self.poll(l, mark)
+            except (ldapom.error.LDAPError, directory.DirectoryUnavailable) as e:
+                self.stderr.write('Polling failed: {}'.format(e))
+                l = None
+            time.sleep(settings.LDAP_POLL_INTERVAL)
+
+    def poll(self, l, mark):
+        # contextCSN is updated by every write under the base; only then look for the
+        # entries changed since the last poll
+        base = next(l.search(base=settings.LDAP_BASE, scope=ldapom.LDAP_SCOPE_BASE,
+                             retrieve_attributes=['contextCSN']), None)
+        if base is None or not base.contextCSN:
+            self.stderr.write('Cannot read contextCSN of {}: the service account needs read '
+                              'access to the base entry'.format(settings.LDAP_BASE))
+            return mark
+        csn = max(base.contextCSN)
+        if mark is None or csn == mark:
+            return csn
+
+        # The changed entries the service account can read only serve to measure the lag: the
+        # cached entries may be among those it cannot read (groups), or deleted, so every
+        # cached entry is evicted
+        changes = []
+        for entry in l.search('(entryCSN>={})'.format(mark),
+                              retrieve_attributes=['modifyTimestamp']):
+            timestamp = entry.get_attribute('modifyTimestamp')
+            changes.append((entry.dn, timestamp.value if timestamp else None))
+        changes.append(('*', None))
+
+        seq = directory.publish_invalidations(changes)
+        self.stdout.write('Published {} changed DNs and a full eviction (sequence {})'
+                          .format(len(changes) - 1, seq))
+        return csn
@@ -0,0 +1,39 @@
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+import ldapom
+
+from . import directory, profiling
+
+
+# Answer with a 503 page instead of a 500 when LDAP is down or stalled
+class DirectoryUnavailableMiddleware(object):
+    def process_exception(self, request, exception):
+        if isinstance(exception, ldapom.error.LDAPError) and directory.is_outage(exception):
+            directory.record_failure()
+            exception = directory.DirectoryUnavailable(directory.breaker_retry_after())
+
+        if isinstance(exception, directory.DirectoryUnavailable):
+            response = render_to_response('503.html',
+                                          context_instance=RequestContext(request),
+                                          status=503)
+            response['Retry-After'] = max(exception.retry_after, 1)
+            return response
+
+
+# Evict the entries other workers or tools changed before handling the request
+class DirectoryInvalidationMiddleware(object):
+    def process_request(self, request):
+        directory.apply_invalidations()
+
+
+# Profile a sample of the requests, or those carrying a signed header, see main/profiling.py
+class ProfilingMiddleware(object):
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if profiling.requested(request):
+            request.sampler = profiling.start(view_func.__name__)
+
+    def process_response(self, request, response):
+        sampler = getattr(request, 'sampler', None)
+        if sampler is not None:
+            profiling.save(sampler.stop())
+        return response
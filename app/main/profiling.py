@@ -0,0 +1,103 @@
+from collections import Counter
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from django.core import signing
+from django.core.cache import cache
+
+from webldap import settings
+
+logger = logging.getLogger(__name__)
+
+# Requests carrying a valid token in this header are always profiled
+HEADER = 'X-Webldap-Profile'
+_META_HEADER = 'HTTP_' + HEADER.upper().replace('-', '_')
+_SALT = 'main.profiling'
+
+
+# Sampling profiler: a thread records the stack of the request thread every
+# PROFILING_INTERVAL seconds, which costs nothing to the request between two samples.
+# Stacks are kept in the folded format of flamegraph.pl ("view;module:function;... count"),
+# rooted at the name of the view.
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, tag):
+        super(Sampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.tag = tag
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(settings.PROFILING_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[fold(frame, self.tag)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+def fold(frame, tag):
+    names = []
+    while frame is not None:
+        names.append('{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    names.append(tag)
+    return ';'.join(reversed(names))
+
+
+def rate():
+    # Share of requests to profile: set from the admin page for PROFILING_DURATION seconds,
+    # PROFILING_RATE otherwise
+    return cache.get('profiling:rate', settings.PROFILING_RATE)
+
+
+def set_rate(value):
+    cache.set('profiling:rate', value, settings.PROFILING_DURATION)
+
+
+def token():
+    return signing.dumps('profile', salt=_SALT)
+
+
+def requested(request):
+    value = request.META.get(_META_HEADER)
+    if value:
+        try:
+            signing.loads(value, salt=_SALT, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            pass
+        else:
+            return True
+
+    sample = rate()
+    return bool(sample) and random.random() < sample
+
+
+def start(tag):
+    sampler = Sampler(threading.get_ident(), tag)
+    sampler.start()
+    return sampler
+
+
+def save(stacks):
+    # One file per day and process, appended to by each profiled request; merge them with
+    # `manage.py profilesummary`
+    if not stacks:
+        return
+
+    path = os.path.join(settings.PROFILING_DIR, '{}-{}.folded'.format(
+        time.strftime('%Y%m%d'), os.getpid()))
+    try:
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        with open(path, 'a') as f:
+            f.writelines('{} {}\n'.format(stack, count) for stack, count in stacks.items())
+    except OSError:
+        logger.exception('Could not write profile to %s', path)
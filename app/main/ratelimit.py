@@ -0,0 +1,69 @@
+import hashlib
+import math
+import time
+
+from django.core.cache import cache
+
+from webldap import settings
+
+
+def _take(bucket, key, limit, period):
+    # Fixed window of `period` seconds allowing `limit` attempts, counted with the atomic
+    # add and incr of the cache so that concurrent requests cannot all pass on the same
+    # count. Returns the number of seconds until the next window, 0 when the attempt is
+    # allowed.
+    now = time.time()
+    window = int(now // period)
+    cache_key = 'ratelimit:{}:{}:{}'.format(
+        bucket, hashlib.sha1(key.encode('utf-8')).hexdigest(), window)
+
+    cache.add(cache_key, 0, period)
+    try:
+        count = cache.incr(cache_key)
+    except ValueError:  # Evicted between add and incr
+        cache.add(cache_key, 1, period)
+        count = 1
+
+    if count > limit:
+        return math.ceil((window + 1) * period - now)
+    return 0
+
+
+def _count(name):
+    key = 'ratelimit:count:{}'.format(name)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:  # Evicted between add and incr
+        pass
+
+
+# Count an attempt for the client address and for `uid`. Returns the number of seconds the
+# client should wait, or 0 if the request may go on.
+def check(request, uid):
+    buckets = (('ip', request.META.get('REMOTE_ADDR', ''), settings.RATELIMIT_IP),
+               ('uid', uid, settings.RATELIMIT_UID))
+
+    for bucket, key, (limit, period) in buckets:
+        wait = _take(bucket, key, limit, period)
+        if wait:
+            _count('rejected_{}'.format(bucket))
+            return wait
+
+    _count('allowed')
+    return 0
+
+
+# Same for the availability check, counted apart from the login attempts, which the live
+# checks of the forms would use up
+def check_availability(request):
+    limit, period = settings.RATELIMIT_AVAILABILITY
+    wait = _take('availability', request.META.get('REMOTE_ADDR', ''), limit, period)
+    _count('rejected_availability' if wait else 'availability_allowed')
+    return wait
+
+
+def stats():
+    names = ('allowed', 'rejected_ip', 'rejected_uid', 'availability_allowed',
+             'rejected_availability')
+    return {name: cache.get('ratelimit:count:{}'.format(name), 0) for name in names}
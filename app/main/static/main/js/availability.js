@@ -0,0 +1,38 @@
+// Live check of the uid and nick fields of the account forms against /check/
+(function () {
+  var messages = {uid: 'Identifiant déjà pris', nick: 'Pseudo déjà pris'};
+  // Without a session, only the form of a pending account request may check (its nick)
+  var request = /^\/process\/([a-z0-9]{32})\/$/.exec(window.location.pathname);
+  var token = request ? '&token=' + request[1] : '';
+
+  function watch(name) {
+    var input = document.getElementById('id_' + name);
+    if (!input) {
+      return;
+    }
+    var initial = input.value;
+    var status = document.createElement('span');
+    status.className = 'availability';
+    input.parentNode.appendChild(status);
+
+    input.addEventListener('change', function () {
+      var value = input.value.trim();
+      status.textContent = '';
+      if (!value || value === initial) {
+        return;
+      }
+      var xhr = new XMLHttpRequest();
+      xhr.open('GET', '/check/?' + name + '=' + encodeURIComponent(value) + token);
+      xhr.onload = function () {
+        if (xhr.status !== 200 || input.value.trim() !== value) {
+          return;
+        }
+        status.textContent = JSON.parse(xhr.responseText)[name] ? '' : ' ' + messages[name];
+      };
+      xhr.send();
+    });
+  }
+
+  watch('uid');
+  watch('nick');
+})();
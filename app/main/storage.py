@@ -0,0 +1,10 @@
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+
+# Collected files are served by the web server or another user than the one running
+# collectstatic: do not let the restrictive umask of the settings apply to them
+class StaticFilesStorage(ManifestStaticFilesStorage):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('file_permissions_mode', 0o644)
+        kwargs.setdefault('directory_permissions_mode', 0o755)
+        super(StaticFilesStorage, self).__init__(*args, **kwargs)
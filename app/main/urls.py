@@ -8,6 +8,7 @@ urlpatterns = patterns(
     url(r'^logout/$', 'logout'),
     url(r'^passwd/$', 'passwd'),
     url(r'^admin/$', 'admin'),
+    url(r'^admin/profiling/$', 'admin_profiling'),
     url(r'^new_org/$', 'new_org'),
     url(r'^org/(?P<uid>[A-Za-z0-9-_]+)/$', 'org'),
     url(r'^org/(?P<uid>[A-Za-z0-9-_]+)/add/$', 'org_add'),
@@ -18,5 +19,6 @@ urlpatterns = patterns(
     url(r'^org/(?P<uid>[A-Za-z0-9-_]+)/enable_admin/(?P<user_uid>[a-z-.]+)/$', 'enable_admin'),
     url(r'^org/(?P<uid>[A-Za-z0-9-_]+)/disable_admin/(?P<user_uid>[a-z-.]+)/$', 'disable_admin'),
     url(r'^process/(?P<token>[a-z0-9]{32})/$', 'process'),
+    url(r'^check/$', 'check_availability'),
     url(r'^help/$', 'help'),
 )
@@ -1,20 +1,27 @@
+from django.views.decorators.cache import cache_control
 from django.views.decorators.debug import sensitive_post_parameters, sensitive_variables
+from django.views.decorators.http import condition
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import Context, RequestContext, loader
+from django.template.response import TemplateResponse
 from django.core.context_processors import csrf
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponseRedirect, Http404, JsonResponse
 from django.core.urlresolvers import reverse
 from django.core.mail import send_mail
 from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.core.cache import cache
 from django.contrib import messages
 
 from .forms import (LoginForm, ProfileForm, ProfilePosixForm, RequestAccountForm, RequestPasswdForm,
                     ProcessAccountForm, ProcessPasswdForm, NewOrgForm)
 from .models import Request
+from . import availability, directory, profiling, ratelimit
 
 from webldap import settings
+from functools import partial, wraps
+import hashlib
 import ldapom
-import re
 
 
 def one(singleton):
@@ -37,32 +44,141 @@ def session_info(request):
 
 # View decorator
 def connect_ldap(view, login_url='/login'):
+    @wraps(view)
     def _view(request, *args, **kwargs):
         if not request.session.get('ldap_connected', False):
             path = request.get_full_path()
             return HttpResponseRedirect('{}?next={}'.format(login_url, path))
         try:
-            l = ldapom.LDAPConnection(uri=settings.LDAP_URI,
-                                      base=settings.LDAP_BASE,
-                                      bind_dn=request.session['ldap_binddn'],
-                                      bind_password=request.session['ldap_passwd'])
+            l = directory.connect(request.session['ldap_binddn'],
+                                  request.session['ldap_passwd'])
         except (KeyError, ldapom.error.LDAPInvalidCredentialsError):
             messages.error(request, 'Identifiants incorrects.')
             return logout(request)
 
-        # Login successful, check if admin
+        # Login successful: the session may now be served stale pages by `fallback`
+        if not request.session.get('ldap_verified', False):
+            request.session['ldap_verified'] = True
+
+        # Check if admin
         if request.session.get('is_admin', None) is None:
-            admins = l.get_entry('cn=admin,ou=roles,{}'.format(settings.LDAP_BASE)) \
-                .roleOccupant
+            admins = (directory.cached_entry('cn=admin,ou=roles,{}'.format(settings.LDAP_BASE),
+                                             l) or {}).get('roleOccupant', set())
             request.session['is_admin'] = request.session['ldap_binddn'] in admins
 
         return view(request, l=l, *args, **kwargs)
     return _view
 
 
-def error(request, error_msg):
+class _Recorded(object):
+    # Callable context value remembering its result once the template called it
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self):
+        self.result = self.func()
+        return self.result
+
+
+# View decorator for read-only pages returning a TemplateResponse: keep their last context
+# and render it again while the directory is unavailable. Only sessions which have bound
+# successfully are served a stored page (login does not check the password), under a key
+# depending on the password as well, through an HMAC keyed by SECRET_KEY so that cache keys
+# cannot be used to guess it.
+def fallback(view):
+    @wraps(view)
+    def _view(request, *args, **kwargs):
+        digest = salted_hmac('main.views.fallback', '{} {} {}'.format(
+            request.session.get('ldap_binddn'), request.session.get('ldap_passwd'),
+            request.get_full_path())).hexdigest()
+        key = 'fallback:{}:{}'.format(view.__name__, digest)
+
+        def store(response):
+            # Values the template did not need this time (cached fragments) keep their
+            # previous result
+            template, stored = cache.get(key) or (None, {})
+            for name, value in response.context_data.items():
+                if not isinstance(value, _Recorded):
+                    stored[name] = value
+                elif hasattr(value, 'result'):
+                    stored[name] = value.result
+            cache.set(key, (response.template_name, stored), settings.LDAP_FALLBACK_TIMEOUT)
+
+        try:
+            response = view(request, *args, **kwargs)
+            if isinstance(response, TemplateResponse):
+                ctx = response.context_data
+                for name, value in ctx.items():
+                    if callable(value):
+                        ctx[name] = _Recorded(value)
+                response.add_post_render_callback(store)
+                # Render here, templates may still query LDAP
+                response.render()
+        except (directory.DirectoryUnavailable, ldapom.error.LDAPError) as e:
+            if isinstance(e, ldapom.error.LDAPError):
+                if not directory.is_outage(e):
+                    raise
+                directory.record_failure()
+
+            stored = cache.get(key) if request.session.get('ldap_verified', False) else None
+            if stored is None:
+                raise directory.DirectoryUnavailable(directory.breaker_retry_after())
+
+            template, ctx = stored
+            ctx['degraded'] = True
+            messages.warning(request, 'Annuaire indisponible, ces informations peuvent'
+                                      ' ne pas être à jour.')
+            return TemplateResponse(request, template, ctx)
+
+        return response
+    return _view
+
+
+# ETag of a page computed from the change stamps of the entries it is built from, so that
+# `condition` answers 304 after base-scope reads only. No ETag while messages are pending,
+# they are part of the page.
+def stamps_etag(request, l, *stamps):
+    if len(messages.get_messages(request)):
+        return None
+
+    stamps = directory.gather(l, *stamps)
+    if None in stamps:
+        return None
+
+    return hashlib.sha1('{} {} {}'.format(
+        request.session['ldap_binddn'], request.session['is_admin'], stamps)
+        .encode('utf-8')).hexdigest()
+
+
+def base_etag(request, l):
+    return stamps_etag(request, l,
+                       partial(directory.stamps, dn=settings.LDAP_BASE,
+                               attributes=('contextCSN',)))
+
+
+def org_etag(request, l, uid):
+    return stamps_etag(request, l, *[
+        partial(directory.stamps, dn=dn) for dn in (
+            'o={},ou=associations,{}'.format(uid, settings.LDAP_BASE),
+            'cn=admin,ou=roles,{}'.format(settings.LDAP_BASE),
+            'cn=ssh,ou=accesses,ou=groups,{}'.format(settings.LDAP_BASE))])
+
+
+def admin_etag(request, l):
+    etag = base_etag(request, l)
+    return etag and '{}-{}'.format(etag, profiling.rate())
+
+
+def error(request, error_msg, status=None):
     return render_to_response('main/error.html', {'error_msg': error_msg},
-                              context_instance=RequestContext(request))
+                              context_instance=RequestContext(request), status=status)
+
+
+def too_many_requests(request, wait):
+    response = error(request, 'Trop de tentatives, réessayez dans quelques minutes.',
+                     status=429)
+    response['Retry-After'] = wait
+    return response
 
 
 def login(request):
@@ -72,6 +188,11 @@ def login(request):
         f = LoginForm(request.POST)
 
         if f.is_valid():
+            # Credentials are checked by binding on the next page, throttle them here
+            wait = ratelimit.check(request, f.cleaned_data['uid'])
+            if wait:
+                return too_many_requests(request, wait)
+
             request.session.flush()
             request.session['ldap_connected'] = True
             request.session['ldap_binduid'] = f.cleaned_data['uid']
@@ -92,33 +213,40 @@ def logout(request, next=None):
     return HttpResponseRedirect(redirect_to)
 
 
+@fallback
+@cache_control(private=True, no_cache=True)
 @connect_ldap
+@condition(etag_func=base_etag)
 def profile(request, l):
-    me = l.get_entry(request.session['ldap_binddn'])
+    me_dn = request.session['ldap_binddn']
+
+    me, org_search, access_search, role_search = directory.gather(
+        l,
+        lambda l: directory.get_entry(l, me_dn),
+        lambda l: list(l.search('uniqueMember={}'.format(me_dn),
+                                base='ou=associations,{}'.format(settings.LDAP_BASE))),
+        lambda l: list(l.search('uniqueMember={}'.format(me_dn),
+                                base='ou=accesses,ou=groups,{}'.format(settings.LDAP_BASE))),
+        lambda l: list(l.search('roleOccupant={}'.format(me_dn),
+                                base='ou=roles,{}'.format(settings.LDAP_BASE))),
+    )
 
-    search = l.search('uniqueMember={}'.format(me.dn),
-                      base='ou=associations,{}'.format(settings.LDAP_BASE))
     orgs = [{
         'uid': one(org.o),
         'name': one(org.cn),
         'is_owner': me.dn in org.owner
-    } for org in search]
+    } for org in org_search]
 
-    search = list(l.search('uniqueMember={}'.format(me.dn),
-                           base='ou=accesses,ou=groups,{}'.format(settings.LDAP_BASE)))
-    search.extend(l.search('roleOccupant={}'.format(me.dn),
-                           base='ou=roles,{}'.format(settings.LDAP_BASE)))
+    groups = [{'name': one(group.cn), } for group in access_search + role_search]
 
-    groups = [{'name': one(group.cn), } for group in search]
-
-    return render_to_response('main/profile.html', {
+    return TemplateResponse(request, 'main/profile.html', {
         'uid': me.uid,
         'name': me.displayName,
         'nick': one(me.cn),
         'email': one(me.mail),
         'orgs': orgs,
         'groups': groups,
-    }, context_instance=RequestContext(request))
+    })
 
 
 @sensitive_post_parameters('passwd')
@@ -163,6 +291,12 @@ def profile_edit(request, l):
     name = f.cleaned_data['name']
     nick = f.cleaned_data['nick']
 
+    taken = nick != one(me.cn) and \
+        not availability.check(nick=nick, exclude_dn=me.dn, cached=False)['nick']
+    if taken:
+        messages.error(request, 'Pseudo déjà pris')
+        return form(ctx, 'main/edit.html', request)
+
     if name != me.displayName or nick != one(me.cn):
         try:
             me.displayName = f.cleaned_data['name']
@@ -224,48 +358,84 @@ def new_org(request, l):
     f = NewOrgForm()
     return form({'form': f}, 'main/new_org.html', request)
 
+@fallback
+@cache_control(private=True, no_cache=True)
 @connect_ldap
+@condition(etag_func=org_etag)
 def org(request, l, uid):
-    org = l.get_entry('o={},ou=associations,{}'.format(uid, settings.LDAP_BASE))
-    admin = l.get_entry('cn=admin,ou=roles,{}'.format(settings.LDAP_BASE))
-    ssh = l.get_entry('cn=ssh,ou=accesses,ou=groups,{}'.format(settings.LDAP_BASE))
-
-    if not org.exists():
+    org = directory.get_entry(l, 'o={},ou=associations,{}'.format(uid, settings.LDAP_BASE),
+                              retrieve_operational_attributes=True)
+    # Missing or unreadable entries count as empty, as for the members
+    admin = directory.cached_entry('cn=admin,ou=roles,{}'.format(settings.LDAP_BASE), l) or {}
+    ssh = directory.cached_entry('cn=ssh,ou=accesses,ou=groups,{}'.format(settings.LDAP_BASE),
+                                 l) or {}
+
+    if org is None:
         raise Http404
 
-    search = [l.get_entry(dn) for dn in org.uniqueMember]
-
-    members = [{
-        'uid': one(member.uid),
-        'name': member.displayName,
-        'owner': member.dn in org.owner,
-        'is_admin': member.dn in admin.roleOccupant,
-        'is_ssh': member.dn in ssh.uniqueMember,
-    } for member in search]
-
-    return render_to_response('main/org.html', {
+    # Only called by the template when the member list fragment is not cached
+    def members():
+        search = directory.gather(l, *[
+            partial(directory.get_entry, dn=dn, retrieve_attributes=['uid', 'displayName'])
+            for dn in org.uniqueMember])
+
+        return [{
+            'uid': one(member.uid),
+            'name': member.displayName,
+            'owner': member.dn in org.owner,
+            'is_admin': member.dn in admin.get('roleOccupant', ()),
+            'is_ssh': member.dn in ssh.get('uniqueMember', ()),
+        } for member in search if member is not None]
+
+    return TemplateResponse(request, 'main/org.html', {
         'uid': uid,
         'name': one(org.cn),
         'is_owner': request.session['ldap_binddn'] in org.owner,
-        'members': members
-    }, context_instance=RequestContext(request))
+        'members': members,
+        # entryCSN rather than modifyTimestamp, which only changes once per second
+        'members_stamp': '{}-{}-{}'.format(org.entryCSN,
+                                           ','.join(admin.get('entryCSN', ())),
+                                           ','.join(ssh.get('entryCSN', ()))),
+    })
+
+
+# Association and target user of the association mutation views, with a single subtree search
+# matching both by their indexed naming attributes. Raises Http404 if either does not exist;
+# `allowed` tells whether the current user may manage the association.
+def org_access(request, l, uid, user_uid=None):
+    org_dn = 'o={},ou=associations,{}'.format(uid, settings.LDAP_BASE)
+    user_dn = 'uid={},ou=users,{}'.format(user_uid, settings.LDAP_BASE)
+
+    search_filter = '(&(objectClass=groupOfUniqueNames)(o={}))'.format(
+        directory.escape_filter(uid))
+    if user_uid is not None:
+        search_filter = '(|{}(&(objectClass=inetOrgPerson)(uid={})))'.format(
+            search_filter, directory.escape_filter(user_uid))
+
+    entries = {directory.normalize_dn(entry.dn): entry for entry in l.search(
+        search_filter, base=settings.LDAP_BASE,
+        retrieve_attributes=['cn', 'owner', 'displayName'])}
+    org = entries.get(directory.normalize_dn(org_dn))
+    user = entries.get(directory.normalize_dn(user_dn))
+
+    if org is None or (user_uid is not None and user is None):
+        raise Http404
+
+    allowed = request.session['ldap_binddn'] in org.owner or request.session['is_admin']
+    return org, user, allowed
 
 
 @connect_ldap
 def org_promote(request, l, uid, user_uid):
-    org = l.get_entry('o={},ou=associations,{}'.format(uid, settings.LDAP_BASE))
-    user = l.get_entry('uid={},ou=users,{}'.format(user_uid, settings.LDAP_BASE))
-
-    if not org.exists() or not user.exists():
-        raise Http404
+    org, user, allowed = org_access(request, l, uid, user_uid)
 
-    if request.session['ldap_binddn'] not in org.owner \
-            and not request.session['is_admin']:
+    if not allowed:
         messages.error(request, 'Vous n\'êtes ni gérant, ni admin')
         return HttpResponseRedirect('/org/{}'.format(uid))
 
-    org.owner.add(user.dn)
-    org.save()
+    # Only send the new value, owner is not rewritten as a whole
+    if user.dn not in org.owner:
+        directory.modify(l, org.dn, [('add', 'owner', [user.dn])])
 
     messages.success(request, '{} est désormais gérant'.format(user.displayName))
     return HttpResponseRedirect('/org/{}'.format(uid))
@@ -273,31 +443,23 @@ def org_promote(request, l, uid, user_uid):
 
 @connect_ldap
 def org_relegate(request, l, uid, user_uid):
-    org = l.get_entry('o={},ou=associations,{}'.format(uid, settings.LDAP_BASE))
-    user = l.get_entry('uid={},ou=users,{}'.format(user_uid, settings.LDAP_BASE))
-
-    if not org.exists() or not user.exists():
-        raise Http404
+    org, user, allowed = org_access(request, l, uid, user_uid)
 
-    if request.session['ldap_binddn'] not in org.owner \
-            and not request.session['is_admin']:
+    if not allowed:
         messages.error(request, 'Vous n\'êtes ni gérant, ni admin')
         return HttpResponseRedirect('/org/{}'.format(uid))
 
-    org.owner.discard(user.dn)
-    org.save()
+    if user.dn in org.owner:
+        directory.modify(l, org.dn, [('delete', 'owner', [user.dn])])
 
     messages.success(request, '{} n\'est plus gérant'.format(user.displayName))
     return HttpResponseRedirect('/org/{}'.format(uid))
 
 @connect_ldap
 def org_add(request, l, uid):
-    org = l.get_entry('o={},ou=associations,{}'.format(uid, settings.LDAP_BASE))
-    if not org.exists():
-        raise Http404
+    org, _, allowed = org_access(request, l, uid)
 
-    if request.session['ldap_binddn'] not in org.owner \
-            and not request.session['is_admin']:
+    if not allowed:
         return error(request, 'Vous n\'êtes pas gérant.')
 
     if request.method == 'POST':
@@ -338,10 +500,10 @@ def make_posix(l, user):
     while uid_number in used_uid or uid_number in used_gid:
         uid_number += 1
 
-    federez_uid = re.sub(r'[^a-zA-Z]+', '', one(user.cn))
+    federez_uid = availability.federez_uid(one(user.cn))
 
     # Ensure the netFederezUID has not already been taken
-    if not list(l.search('netFederezUID={}'.format(federez_uid))) == []:
+    if not availability.check(nick=one(user.cn), exclude_dn=user.dn, cached=False)['nick']:
         return 'Le pseudo est déjà utilisé, impossible d\'ajouter un accès ssh'
 
     user.objectClass.add('shadowAccount')
@@ -387,6 +549,7 @@ def enable_ssh(request, l, uid, user_uid):
 
     ssh.uniqueMember.add(user.dn)
     ssh.save()
+    directory.invalidate(ssh.dn)
 
     messages.success(request, '{} a désormais des accès SSH'.format(user.displayName))
     return HttpResponseRedirect('/org/{}'.format(uid))
@@ -403,6 +566,7 @@ def disable_ssh(request, l, uid, user_uid):
 
     ssh.uniqueMember.discard(user.dn)
     ssh.save()
+    directory.invalidate(ssh.dn)
 
     messages.success(request, '{} n\'a plus d\'accès SSH'.format(user.displayName))
     return HttpResponseRedirect('/org/{}'.format(uid))
@@ -427,6 +591,8 @@ def enable_admin(request, l, uid, user_uid):
 
     admin.roleOccupant.add(user.dn)
     admin.save()
+    directory.invalidate(sudo_ssh.dn)
+    directory.invalidate(admin.dn)
 
     messages.success(request,
                      '{} est désormais admin et a des accès sudo sur les serveurs'
@@ -449,6 +615,8 @@ def disable_admin(request, l, uid, user_uid):
 
     admin.roleOccupant.discard(user.dn)
     admin.save()
+    directory.invalidate(sudo_ssh.dn)
+    directory.invalidate(admin.dn)
 
     messages.success(request,
                      '{} n\'est plus admin et ses accès ssh sudo ont été révoqués'
@@ -456,9 +624,12 @@ def disable_admin(request, l, uid, user_uid):
     return HttpResponseRedirect('/org/{}'.format(uid))
 
 
+@fallback
+@cache_control(private=True, no_cache=True)
 @connect_ldap
+@condition(etag_func=admin_etag)
 def admin(request, l):
-    me = l.get_entry(request.session['ldap_binddn'])
+    me_dn = request.session['ldap_binddn']
 
     if not request.session['is_admin']:
         return error(request, 'Vous n\'êtes pas administrateur')
@@ -468,11 +639,36 @@ def admin(request, l):
     orgs = [{
         'uid': one(org.o),
         'name': one(org.cn),
-        'is_owner': me.dn in org.owner,
+        'is_owner': me_dn in org.owner,
     } for org in search]
 
-    return render_to_response('main/admin.html', {'orgs': orgs},
-                              context_instance=RequestContext(request))
+    return TemplateResponse(request, 'main/admin.html', {
+        'orgs': orgs,
+        'profiling_rate': profiling.rate(),
+    })
+
+
+@connect_ldap
+def admin_profiling(request, l):
+    if not request.session['is_admin']:
+        return error(request, 'Vous n\'êtes pas administrateur')
+
+    if request.method == 'POST':
+        if 'token' in request.POST:
+            messages.info(request, 'En-tête valable {} min : {}: {}'.format(
+                settings.PROFILING_TOKEN_MAX_AGE // 60, profiling.HEADER, profiling.token()))
+        else:
+            try:
+                rate = float(request.POST.get('rate', ''))
+            except ValueError:
+                rate = -1
+            if not 0 <= rate <= 1:
+                messages.error(request, 'Proportion invalide')
+            else:
+                profiling.set_rate(rate)
+                messages.success(request, 'Profilage mis à jour')
+
+    return HttpResponseRedirect('/admin')
 
 
 def passwd(request):
@@ -480,10 +676,11 @@ def passwd(request):
         f = RequestPasswdForm(request.POST)
         if f.is_valid():
             req = f.save(commit=False)
-            l = ldapom.LDAPConnection(uri=settings.LDAP_URI,
-                                      base=settings.LDAP_BASE,
-                                      bind_dn=settings.LDAP_WEBLDAP_USER,
-                                      bind_password=settings.LDAP_WEBLDAP_PASSWD)
+            wait = ratelimit.check(request, req.uid)
+            if wait:
+                return too_many_requests(request, wait)
+
+            l = directory.connect_service()
             try:
                 user = list(l.search('(&(uid={})(mail={}))'.format(req.uid, req.email),
                                      base='ou=users,{}'.format(settings.LDAP_BASE)))[0]
@@ -532,16 +729,17 @@ def process_account(request, req):
     if not f.is_valid():
         return form({'form': f}, 'main/process_account.html', request)
 
-    l = ldapom.LDAPConnection(uri=settings.LDAP_URI,
-                              base=settings.LDAP_BASE,
-                              bind_dn=settings.LDAP_WEBLDAP_USER,
-                              bind_password=settings.LDAP_WEBLDAP_PASSWD)
+    l = directory.connect_service()
     user = l.get_entry('uid={},ou=users,{}'.format(req.uid, settings.LDAP_BASE))
 
     if user.exists():
         messages.error(request, 'Compte déjà créé')
         return HttpResponseRedirect('/')
 
+    if not availability.check(nick=f.cleaned_data['nick'], cached=False)['nick']:
+        f.add_error('nick', 'Pseudo déjà pris')
+        return form({'form': f}, 'main/process_account.html', request)
+
     user.objectClass = 'inetOrgPerson'
     user.uid = req.uid
     user.displayName = req.name
@@ -590,10 +788,7 @@ def process_passwd(request, req):
     if request.method == 'POST':
         f = ProcessPasswdForm(request.POST)
         if f.is_valid():
-            l = ldapom.LDAPConnection(uri=settings.LDAP_URI,
-                                      base=settings.LDAP_BASE,
-                                      bind_dn=settings.LDAP_WEBLDAP_USER,
-                                      bind_password=settings.LDAP_WEBLDAP_PASSWD)
+            l = directory.connect_service()
             user = l.get_entry('uid={},ou=users,{}'.format(req.uid, settings.LDAP_BASE))
 
             try:
@@ -629,5 +824,26 @@ def process_email(request, l, req):
     return HttpResponseRedirect('/')
 
 
+# Live check for the account forms: /check/?uid=...&nick=... for logged in users, and
+# /check/?nick=...&token=... for the account creation form of a pending request. Whether a
+# uid exists is not disclosed to anyone else.
+def check_availability(request):
+    wait = ratelimit.check_availability(request)
+    if wait:
+        response = JsonResponse({'error': 'rate limited'}, status=429)
+        response['Retry-After'] = wait
+        return response
+
+    logged_in = request.session.get('ldap_connected', False)
+    if not logged_in and not Request.objects.filter(
+            type=Request.ACCOUNT, token=request.GET.get('token', '')[:32],
+            expires_at__gt=timezone.now()).exists():
+        return JsonResponse({'error': 'forbidden'}, status=403)
+
+    uid = request.GET.get('uid', '').strip()[:200] if logged_in else ''
+    nick = request.GET.get('nick', '').strip()[:100]
+    return JsonResponse(availability.check(uid=uid or None, nick=nick or None))
+
+
 def help(request):
     return render_to_response('main/help.html', context_instance=RequestContext(request))
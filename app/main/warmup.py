@@ -0,0 +1,87 @@
+import logging
+import os
+import time
+
+from django.db import connection
+from django.template import loader
+
+from webldap import settings
+
+logger = logging.getLogger(__name__)
+
+# Entries read by connect_ldap and the association and admin views. Only the role is
+# required: the service account may not be allowed to read the groups, which are then read
+# with the connection of the first user who needs them.
+REQUIRED_ENTRY = 'cn=admin,ou=roles,{}'
+WELL_KNOWN_ENTRIES = (
+    REQUIRED_ENTRY,
+    'cn=ssh,ou=accesses,ou=groups,{}',
+    'cn=sudoldap,ou=posix,ou=groups,{}',
+)
+
+
+def precompile_templates():
+    # With the cached loader, loading a template once keeps it compiled for the life of
+    # the worker
+    count = 0
+    for template_dir in settings.TEMPLATE_DIRS:
+        for root, dirs, files in os.walk(template_dir):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), template_dir)
+                loader.get_template(path)
+                count += 1
+    return count
+
+
+def import_views():
+    # Views are imported by the URL resolver on the first request, and ldapom with them
+    from main import views  # NOQA
+
+
+def prime_directory():
+    from main import directory
+
+    # Catch up with the invalidation log first, or the first request would drop the cache
+    directory.apply_invalidations()
+    for dn in WELL_KNOWN_ENTRIES:
+        directory.cached_entry(dn.format(settings.LDAP_BASE))
+
+    if settings.LDAP_CONCURRENCY:
+        directory.executor()
+
+
+def self_check():
+    from main import directory
+
+    connection.ensure_connection()
+    for dn in WELL_KNOWN_ENTRIES:
+        dn = dn.format(settings.LDAP_BASE)
+        if directory.cached_entry(dn) is not None:
+            continue
+        if dn == REQUIRED_ENTRY.format(settings.LDAP_BASE):
+            raise RuntimeError('{} is missing'.format(dn))
+        logger.warning('%s is not readable with the service account', dn)
+
+
+def run():
+    # Failing stages are logged and skipped: a worker should still start when LDAP is down
+    stages = [('imports', import_views)]
+    if settings.TEMPLATE_CACHE:
+        stages.append(('templates', precompile_templates))
+    stages.extend([('directory', prime_directory), ('self-check', self_check)])
+
+    report = []
+    for name, stage in stages:
+        start = time.perf_counter()
+        try:
+            stage()
+        except Exception:
+            logger.exception('Warm-up stage %s failed', name)
+            ok = False
+        else:
+            ok = True
+        report.append((name, time.perf_counter() - start, ok))
+
+    logger.info('Warm-up: %s', ', '.join('{} {:.0f} ms{}'.format(
+        name, 1000 * elapsed, '' if ok else ' (failed)') for name, elapsed, ok in report))
+    return report
@@ -19,6 +19,9 @@ TEMPLATE_DIRS = (
     '/srv/webldap/templates',
 )
 
+STATIC_ROOT = '/srv/webldap/static'
+SERVE_STATIC = not DEBUG
+
 EMAIL_FROM = 'root@localhost'
 
 REQ_EXPIRE_HRS = 48
@@ -12,6 +12,45 @@ DATABASES = {
     }
 }
 
+# Cache shared by the workers, used for sessions and page fragments. The local memory
+# cache is enough for a single process; use memcached when running several workers:
+#   'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#   'LOCATION': '127.0.0.1:11211',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Session engine: 'db', 'cached_db' (cache in front of the database) or 'cache' (cache only,
+# sessions are lost when it is flushed). Compare them with `python manage.py benchsessions`.
+# Only use 'cached_db' or 'cache' with a cache shared by all the workers (memcached): with
+# the local memory cache, a logout or password change in one worker is not seen by the
+# others, which keep serving the old session and the LDAP password it holds.
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'  # With memcached
+
+# Login and password reset attempts allowed per client address and per uid, as
+# (attempts, window in seconds). Rejected attempts get a 429 without reaching LDAP; see
+# `python manage.py ratelimitstats`. The counters live in CACHES, which must be shared by the
+# workers (memcached) for the limits to hold across them. The client address is REMOTE_ADDR:
+# behind a reverse proxy it is the proxy's, and the per-address limit becomes global to all
+# clients; set REMOTE_ADDR from the proxy's header (in the web server or a middleware) then.
+RATELIMIT_IP = (30, 60)
+RATELIMIT_UID = (5, 60)
+
+# Seconds a free uid or nick is cached by the availability check of the account forms
+# (/check/), and its own rate limit per client address
+AVAILABILITY_CACHE_TIMEOUT = 10
+RATELIMIT_AVAILABILITY = (60, 60)
+
+# Sampling profiler, off by default. Admins can profile a share of the requests for
+# PROFILING_DURATION seconds, or get a token for the X-Webldap-Profile header, from the admin
+# page. Stacks are appended to PROFILING_DIR in the flamegraph.pl folded format; merge them
+# with `python manage.py profilesummary`.
+PROFILING_RATE = 0
+PROFILING_DIR = '/var/lib/webldap/profiles'
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = ''
 
@@ -19,6 +58,26 @@ SECRET_KEY = ''
 TEMPLATE_DIRS = (
 )
 
+# Cache compiled templates in memory. Templates are then only read from disk once per
+# worker, so enable it in production.
+TEMPLATE_CACHE = not DEBUG
+
+# Warm each worker up when the WSGI application is loaded, instead of during its first
+# requests: compile all templates, connect to LDAP, cache the role entries and check them.
+# `python manage.py warmup` compares first-request latency with and without it.
+# With a preloading server (gunicorn --preload), this runs once in the master: workers keep
+# the compiled templates but open their own LDAP connections. To also warm these up, set
+# WARMUP = False and call `main.warmup.run()` from the server's post-fork hook instead.
+WARMUP = not DEBUG
+
+# Static files are collected to STATIC_ROOT with content-hashed names, then compressed:
+#     python manage.py collectstatic --noinput && python manage.py compressstatic
+# Both must be run again after each upgrade. With SERVE_STATIC, the WSGI application serves
+# them itself with far-future cache headers, precompressed with gzip, or brotli if the
+# `brotli` module is installed; otherwise have the web server serve STATIC_ROOT at /static/.
+STATIC_ROOT = '/var/www/webldap/static'
+SERVE_STATIC = not DEBUG
+
 # SMTP relay (host and port) to use for confirmation mails
 EMAIL_HOST = 'mail.example.net'
 EMAIL_PORT = 25
@@ -49,6 +108,55 @@ LDAP_WEBLDAP_USER = 'uid=webldap,ou=apps,dc=example,dc=net'
 # LDAP application password
 LDAP_WEBLDAP_PASSWD = 'secret'
 
-# Default LDAP groups and roles for created users
+# LDAP timeouts in seconds: TCP connect, any synchronous operation (binds included) and
+# server-side search time limit. Number of reconnections tried when the server goes away.
+LDAP_NETWORK_TIMEOUT = 5
+LDAP_TIMEOUT = 10
+LDAP_TIMELIMIT = 10
+LDAP_RECONNECT_RETRIES = 1
+
+# After LDAP_BREAKER_THRESHOLD consecutive LDAP failures, pages are answered with a 503 for
+# LDAP_BREAKER_COOLDOWN seconds without contacting the server. The profile, association and
+# admin pages are served from their last version meanwhile, kept LDAP_FALLBACK_TIMEOUT
+# seconds.
+LDAP_BREAKER_THRESHOLD = 5
+LDAP_BREAKER_COOLDOWN = 30
+LDAP_FALLBACK_TIMEOUT = 24 * 3600
+
+# Number of threads per process running the independent LDAP reads of the profile,
+# association and admin pages concurrently. 0 runs them one after the other on the request
+# connection. Otherwise the extra reads use connections bound as the same user, of which
+# LDAP_POOL_SIZE are kept idle per process: each user missing from it costs extra binds.
+# Compare both with `python manage.py benchldap`, with as many users as you expect at once.
+LDAP_CONCURRENCY = 0
+LDAP_POOL_SIZE = 16
+
+# Role and access group entries are cached in each worker. Run `python manage.py
+# watchdirectory` once, next to the workers: every LDAP_POLL_INTERVAL seconds it checks the
+# contextCSN of LDAP_BASE and, when it moved, publishes an eviction through CACHES (which
+# must then be shared: memcached or the file cache), applied by the workers before their
+# next request. The log keeps the last LDAP_INVALIDATION_LOG changes; workers lagging further
+# behind drop their whole cache.
+# contextCSN and entryCSN are maintained by the syncprov overlay, which slapd must load on the
+# database (the Docker image does not), and the service account must be allowed to read the
+# base entry, e.g. with an ACL before the catch-all rule:
+#   to dn.base="dc=example,dc=net" attrs=entry,contextCSN
+#     by dn="cn=webldap,ou=service-users,dc=example,dc=net" read by * break
+LDAP_POLL_INTERVAL = 5
+LDAP_INVALIDATION_LOG = 1000
+
+# Without the poller, or with a cache local to each worker, a change made elsewhere is seen
+# after at most this many seconds
+LDAP_ENTRY_CACHE_TIMEOUT = 60
+
+# checkdirectory and reconciledefaults read ou=users and the groups with the paged results
+# control, LDAP_PAGE_SIZE entries at a time. A page must fit within the size limit of the
+# service account, and slapd also caps the total of a paged search (size.prtotal, the hard
+# limit by default), e.g.:
+#   olcLimits: dn.exact="cn=webldap,ou=service-users,dc=example,dc=net" size.prtotal=unlimited
+LDAP_PAGE_SIZE = 500
+
+# Default LDAP groups and roles for created users. After adding one, add the existing users
+# with `python manage.py reconciledefaults` (--dry-run to only count them).
 LDAP_DEFAULT_GROUPS = ['wiki']
 LDAP_DEFAULT_ROLES = ['member']
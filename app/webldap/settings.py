@@ -20,18 +20,89 @@ STATICFILES_FINDERS = (
     'django.contrib.staticfiles.finders.AppDirectoriesFinder',
 )
 
+# Serve STATIC_ROOT from the WSGI application, with immutable cache headers for hashed names
+# and the copies precompressed by `manage.py compressstatic` (see webldap/static.py)
+SERVE_STATIC = False
+
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
     'django.template.loaders.app_directories.Loader',
 )
 
+# Keep compiled templates in memory
+TEMPLATE_CACHE = False
+
+# Prepare each worker when the WSGI application is loaded: compile the templates, connect to
+# LDAP and fill the role cache (see main/warmup.py)
+WARMUP = False
+
 MIDDLEWARE_CLASSES = (
+    'main.middleware.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'main.middleware.DirectoryUnavailableMiddleware',
+    'main.middleware.DirectoryInvalidationMiddleware',
 )
 
+# Sessions are read on every page. 'cached_db' or 'cache' serve them from CACHES instead of
+# the database; signed cookies are refused since the session holds the LDAP password.
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+# Only write sessions back when a view changed them
+SESSION_SAVE_EVERY_REQUEST = False
+
+# Rate limits in front of login and password reset, per client address and per uid:
+# (attempts, window in seconds)
+RATELIMIT_IP = (30, 60)
+RATELIMIT_UID = (5, 60)
+
+# Rate limit of the availability check of the account forms, per client address
+RATELIMIT_AVAILABILITY = (60, 60)
+
+# LDAP timeouts in seconds: TCP connect, any synchronous operation (binds included) and
+# server-side search time limit
+LDAP_NETWORK_TIMEOUT = 5
+LDAP_TIMEOUT = 10
+LDAP_TIMELIMIT = 10
+LDAP_RECONNECT_RETRIES = 1
+
+# Circuit breaker: after this many consecutive LDAP failures, answer with a 503 (or the
+# last known version of read-only pages) for the cooldown period in seconds
+LDAP_BREAKER_THRESHOLD = 5
+LDAP_BREAKER_COOLDOWN = 30
+LDAP_FALLBACK_TIMEOUT = 24 * 3600
+
+# Number of threads running the independent LDAP reads of a page concurrently (0: run them
+# one after the other on the request connection), and number of idle connections they keep
+# per process for the next requests of the same users
+LDAP_CONCURRENCY = 0
+LDAP_POOL_SIZE = 16
+
+# Seconds between two polls of `manage.py watchdirectory`, and number of changed DNs kept in
+# the invalidation log read by the workers
+LDAP_POLL_INTERVAL = 5
+LDAP_INVALIDATION_LOG = 1000
+
+# Seconds role and access group entries stay cached in a worker without an invalidation
+LDAP_ENTRY_CACHE_TIMEOUT = 60
+
+# Entries per page of the paged searches over whole subtrees (management commands)
+LDAP_PAGE_SIZE = 500
+
+# Seconds a free uid or nick answer of the availability check is cached
+AVAILABILITY_CACHE_TIMEOUT = 10
+
+# Sampling profiler: share of requests profiled (the admin page can change it for
+# PROFILING_DURATION seconds), seconds between two samples, validity of the tokens for the
+# X-Webldap-Profile header and directory of the folded stacks
+PROFILING_RATE = 0
+PROFILING_INTERVAL = 0.005
+PROFILING_DURATION = 3600
+PROFILING_TOKEN_MAX_AGE = 3600
+PROFILING_DIR = '/tmp/webldap-profiles'
+
 ROOT_URLCONF = 'webldap.urls'
 
 WSGI_APPLICATION = 'webldap.wsgi.application'
@@ -76,3 +147,18 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 import os
 os.umask(0o077)
 from .local_settings import *
+
+if SESSION_ENGINE == 'django.contrib.sessions.backends.signed_cookies':
+    from django.core.exceptions import ImproperlyConfigured
+    raise ImproperlyConfigured('Signed cookie sessions would expose the LDAP password')
+
+# With STATIC_ROOT, collectstatic copies the files there under names containing a hash of
+# their content, which the templates use when DEBUG is off. Pages then fail to render until
+# collectstatic has been run, so this is only enabled for deployments collecting them.
+if STATIC_ROOT:
+    STATICFILES_STORAGE = 'main.storage.StaticFilesStorage'
+
+if TEMPLATE_CACHE:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
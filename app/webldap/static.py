@@ -0,0 +1,107 @@
+import json
+import mimetypes
+import os
+from wsgiref.headers import Headers
+
+# Encodings of the precompressed copies, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+MUTABLE = 'public, max-age=3600'
+
+
+def accepted_encodings(environ):
+    accepted = set()
+    for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = part.partition(';')
+        name, _, value = params.partition('=')
+        try:
+            if name.strip() == 'q' and float(value) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def read(f):
+    with f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            yield chunk
+
+
+# WSGI middleware serving the files collected in STATIC_ROOT, indexed once when the
+# application is loaded. Names hashed by ManifestStaticFilesStorage never change content and
+# get far-future immutable cache headers; the copies precompressed by
+# `manage.py compressstatic` are sent to the clients accepting their encoding. Anything else
+# goes to the Django application.
+class StaticFiles(object):
+    def __init__(self, application, root, url):
+        self.application = application
+        self.prefix = url
+        self.files = {}
+
+        try:
+            with open(os.path.join(root, 'staticfiles.json')) as f:
+                hashed = set(json.load(f)['paths'].values())
+        except (OSError, ValueError, KeyError):
+            hashed = set()
+
+        suffixes = tuple(suffix for _, suffix in ENCODINGS)
+        for directory, dirs, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                relative = os.path.relpath(path, root).replace(os.sep, '/')
+                if name.endswith(suffixes) or relative == 'staticfiles.json':
+                    continue
+                self.files[relative] = self.entry(path, relative in hashed)
+
+    def entry(self, path, immutable):
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+
+        variants = [(None, path, os.path.getsize(path))]
+        for encoding, suffix in ENCODINGS:
+            if os.path.exists(path + suffix):
+                variants.insert(-1, (encoding, path + suffix, os.path.getsize(path + suffix)))
+
+        return {
+            'content_type': content_type,
+            'cache_control': IMMUTABLE if immutable else MUTABLE,
+            'variants': variants,
+        }
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        method = environ.get('REQUEST_METHOD')
+        if not path.startswith(self.prefix) or method not in ('GET', 'HEAD'):
+            return self.application(environ, start_response)
+
+        entry = self.files.get(path[len(self.prefix):])
+        if entry is None:
+            return self.application(environ, start_response)
+
+        accepted = accepted_encodings(environ)
+        encoding, filename, size = next(variant for variant in entry['variants']
+                                        if variant[0] is None or variant[0] in accepted)
+
+        headers = Headers([])
+        headers['Content-Type'] = entry['content_type']
+        headers['Content-Length'] = str(size)
+        headers['Cache-Control'] = entry['cache_control']
+        if len(entry['variants']) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        start_response('200 OK', headers.items())
+
+        if method == 'HEAD':
+            return []
+        f = open(filename, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(f)
+        return read(f)
@@ -26,6 +26,16 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webldap.settings")
 # setting points here.
 application = get_wsgi_application()
 
+from django.conf import settings
+
+if settings.WARMUP:
+    from main import warmup
+    warmup.run()
+
+if settings.SERVE_STATIC:
+    from webldap.static import StaticFiles
+    application = StaticFiles(application, settings.STATIC_ROOT, settings.STATIC_URL)
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)